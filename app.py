@@ -25,18 +25,22 @@ def _ok(payload: Dict[str, Any], status: int = 200):
 def _err(detail: str, err_type: str = "Error", status: int = 400):
     return jsonify({"ok": False, "error": err_type, "detail": detail}), status
 
+_MDY_RE = re.compile(r"\d{1,2}/\d{1,2}/\d{4}")
+_YMD_RE = re.compile(r"(\d{4})[-/](\d{1,2})[-/](\d{1,2})")
+_MDY_ANY_RE = re.compile(r"(\d{1,2})[-/](\d{1,2})[-/](\d{2,4})")
+
 def _norm_date(s: str) -> str:
     if not s:
         raise ValueError("Empty date")
     t = s.strip()
-    if re.fullmatch(r"\d{1,2}/\d{1,2}/\d{4}", t):
+    if _MDY_RE.fullmatch(t):
         m, d, y = t.split("/")
         return f"{int(m):02d}/{int(d):02d}/{int(y):04d}"
-    m = re.fullmatch(r"(\d{4})[-/](\d{1,2})[-/](\d{1,2})", t)
+    m = _YMD_RE.fullmatch(t)
     if m:
         y, mo, d = m.groups()
         return f"{int(mo):02d}/{int(d):02d}/{int(y):04d}"
-    m = re.fullmatch(r"(\d{1,2})[-/](\d{1,2})[-/](\d{2,4})", t)
+    m = _MDY_ANY_RE.fullmatch(t)
     if m:
         mo, d, y = m.groups()
         if len(y) == 2:
@@ -1,15 +1,59 @@
 from __future__ import annotations
-import os, json, random
+import heapq, os, json, logging, random
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Tuple, Dict, Any
+from functools import lru_cache
+from itertools import count
+from typing import List, Tuple, Dict, Any, Sequence
+
+try:
+    import orjson  # optional: faster JSON, stdlib json is the fallback
+except ImportError:
+    orjson = None
+
+_log = logging.getLogger(__name__)
+
+_SAVE_DIR = "/tmp"
+_SAVE_SEQ = count()
+
+# single background thread for save files, so requests don't wait on disk;
+# concurrent.futures joins it at interpreter exit, flushing pending writes
+_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lotto-save")
+
+def _write_bytes(path: str, data: bytes) -> None:
+    # write beside the target and rename over it, so recent_files() never lists
+    # a half-written save (the .tmp suffix keeps it out of the *.json match)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def _report_write_error(fut) -> None:
+    # nobody waits on the save future, so a failed write would otherwise vanish
+    exc = fut.exception()
+    if exc is not None:
+        _log.error("saving Phase 1 result failed: %s", exc, exc_info=exc)
+
+def _json_loads(s: str) -> Any:
+    return orjson.loads(s) if orjson is not None else json.loads(s)
+
+def _json_dumps_bytes(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
 
 # ----- helpers to parse inputs from UI -----
 def _parse_latest(val: Any, expect_count: int) -> Tuple[List[int], int | None]:
     """
     Accepts JSON string like "[[1,2,3,4,5], 10]" (MM/PB) or "[[1,2,3,4,5,6], null]" (IL).
+    Python-literal spellings ("None", single quotes) are accepted too, but never eval()'d.
     """
     if isinstance(val, str):
-        data = json.loads(val)
+        try:
+            data = _json_loads(val)
+        except ValueError:
+            # tolerate Python spellings (None, single quotes) in one more JSON pass
+            data = _json_loads(val.replace("None", "null").replace("'", '"'))
     else:
         data = val
     if not isinstance(data, list) or len(data) != 2:
@@ -22,6 +66,31 @@ def _parse_latest(val: Any, expect_count: int) -> Tuple[List[int], int | None]:
         return mains, None
     return mains, int(bonus)
 
+# every game number is below this; pasted history is held to it so bitmasks stay small
+_MAX_NUM = 100
+
+# hard caps on pasted history; a real draw history is a few hundred lines
+_MAX_BLOB_CHARS = 1 << 20
+_MAX_BLOB_LINES = 5000
+
+_cap_warned = False  # truncation is logged once per process, not per request
+
+def _cap_blob(text: str | None) -> str:
+    """Cut a pasted history blob to _MAX_BLOB_CHARS / _MAX_BLOB_LINES at a line boundary."""
+    global _cap_warned
+    text = text or ""
+    size = len(text)
+    if size > _MAX_BLOB_CHARS:
+        text = text[:text.rfind("\n", 0, _MAX_BLOB_CHARS) + 1]
+    lines = text.splitlines()
+    if len(lines) > _MAX_BLOB_LINES:
+        text = "\n".join(lines[:_MAX_BLOB_LINES])
+    if len(text) < size and not _cap_warned:
+        _cap_warned = True
+        _log.warning("history blob of %d chars truncated to %d (caps: %d chars, %d lines); "
+                     "further truncations are not logged", size, len(text), _MAX_BLOB_CHARS, _MAX_BLOB_LINES)
+    return text
+
 def _parse_hist_blob(text: str, is_bonus: bool) -> List[Tuple[List[int], int | None]]:
     """
     Lines like:
@@ -31,11 +100,19 @@ def _parse_hist_blob(text: str, is_bonus: bool) -> List[Tuple[List[int], int | N
     """
     out = []
     for raw in (text or "").splitlines():
-        raw = raw.strip()
-        if not raw: 
-            continue
         parts = raw.split()
-        nums = [int(x) for x in parts if x.replace("-","").isdigit()]
+        if not parts:
+            continue
+        # leading mm-dd-yy / yyyy-mm-dd column is the draw date, not numbers (a date
+        # on its own line leaves nothing and is skipped; no draw has only 3 numbers)
+        if parts[0].count("-") == 2:
+            parts = parts[1:]
+        # mains are hyphen-joined; split + isdigit, no regex and no int("17-18-...")
+        nums = [int(x) for p in parts for x in p.split("-") if x.isdigit()]
+        # skip empty lines and lines with out-of-range numbers (not a real draw,
+        # and _mask needs the bound)
+        if not nums or max(nums) >= _MAX_NUM:
+            continue
         # Extract mains and optional bonus by length
         if is_bonus:
             *mains, b = nums
@@ -44,36 +121,85 @@ def _parse_hist_blob(text: str, is_bonus: bool) -> List[Tuple[List[int], int | N
             out.append((nums, None))
     return out
 
+@lru_cache(maxsize=32)
+def _parse_hist_blob_cached(text: str, is_bonus: bool) -> Tuple[Tuple[Tuple[int, ...], int | None], ...]:
+    """
+    Memoized _parse_hist_blob: the UI resubmits the same history text on every
+    click. Rows come back as tuples so the shared cached value can't be mutated.
+    Callers pass _cap_blob()'d text, so cached keys stay bounded too.
+    """
+    return tuple((tuple(mains), b) for mains, b in _parse_hist_blob(text, is_bonus))
+
 # ----- sampling strategies -----
-def _sample_from_hist(hist: List[Tuple[List[int], int | None]], k: int, size: int) -> List[List[int]]:
+def _mask(nums: List[int]) -> int:
+    """Bitmask with bit n set for every number n (callers keep n in 0.._MAX_NUM-1)."""
+    m = 0
+    for n in nums:
+        m |= 1 << n
+    return m
+
+def _target_mask(nums: Sequence[int]) -> int:
+    """_mask for LATEST_* targets, which are not range-checked: numbers outside
+    0.._MAX_NUM-1 can never match a generated row, so they are left out."""
+    return _mask([n for n in nums if 0 <= n < _MAX_NUM])
+
+# fallback pools when no history is given (MM/PB vs IL ranges)
+_FALLBACK_POOL_5 = tuple(range(1, 71))
+_FALLBACK_POOL_6 = tuple(range(1, 47))
+# how many numbers a generated row keeps from its base history draw
+_KEEP_SIZES = (2, 3)
+
+def _sample_from_hist(hist: Sequence[Tuple[Sequence[int], int | None]], k: int, size: int,
+                      rng: random.Random | None = None) -> List[List[int]]:
     """
     Build a 50-row batch by mixing history draws and small variations.
     k = how many mains per row (5 for MM/PB, 6 for IL)
+    rng = random source (handle_run passes a per-request instance)
     """
-    out: List[List[int]] = []
+    if rng is None:
+        rng = random.Random()
     if not hist:
         # fallback random
-        pool = list(range(1, 71)) if k == 5 else list(range(1, 47))
-        while len(out) < size:
-            row = sorted(random.sample(pool, k))
-            out.append(row)
-        return out
+        pool = _FALLBACK_POOL_5 if k == 5 else _FALLBACK_POOL_6
+        return [sorted(rng.sample(pool, k)) for _ in range(size)]
 
-    pool = sorted({n for mains,_ in hist for n in mains})
-    while len(out) < size:
-        base_mains, _ = random.choice(hist)
+    # distinct history numbers: OR every draw into one "seen" mask, then read
+    # the set bits back in ascending order (no set + sort)
+    seen = 0
+    for mains, _ in hist:
+        seen |= _mask(mains)
+    pool = tuple(n for n in range(seen.bit_length()) if seen >> n & 1)
+    out: List[List[int]] = []
+    for _ in range(size):
+        base_mains, _ = rng.choice(hist)
         # keep 2–3 numbers from history row, fill the rest from pool biasing to history
-        keep = random.sample(base_mains, k= min(len(base_mains), random.choice([2,3])))
-        remain_pool = [n for n in pool if n not in keep]
-        row = sorted(keep + random.sample(remain_pool, k - len(keep)))
+        keep = rng.sample(base_mains, k= min(len(base_mains), rng.choice(_KEEP_SIZES)))
+        # draw k from the whole pool and drop anything already kept: still a
+        # uniform pick from pool-minus-keep, without rebuilding that list per row
+        keep_mask = _mask(keep)
+        fill = [n for n in rng.sample(pool, k) if not keep_mask >> n & 1]
+        row = sorted(keep + fill[:k - len(keep)])
         out.append(row)
     return out
 
-def _score_lotto(row: List[int], target: List[int]) -> int:
-    return len(set(row) & set(target))
+# zero-padded "00".."99" so formatting is a lookup, not a format call; a dict, not
+# a tuple, so negatives miss instead of wrapping around
+_PAD2 = {i: f"{i:02d}" for i in range(100)}
+
+def fmt_nums(nums: Sequence[int]) -> str:
+    """Numbers as "01-02-03"; also formats lottery_store's history lines."""
+    try:
+        return "-".join([_PAD2[n] for n in nums])
+    except KeyError:  # anything outside 0..99
+        return "-".join(f"{n:02d}" for n in nums)
 
-def _score_plus_bonus(row: List[int], b: int | None, target: List[int], tb: int | None) -> Tuple[int, bool]:
-    return _score_lotto(row, target), (b is not None and tb is not None and b == tb)
+def _fmt_row(nums: Sequence[int], bonus: int | None = None) -> str:
+    mains = fmt_nums(nums)
+    return mains if bonus is None else f"{mains}  {bonus:02d}"
+
+# hit count -> (tier key, tier key with bonus) for scoring
+_MM_PB_KEYS = {3: ("3", "3+B"), 4: ("4", "4+B"), 5: ("5", "5+B")}
+_IL_KEYS = {3: "3", 4: "4", 5: "5", 6: "6"}
 
 # ----- main handler -----
 def handle_run(payload: Dict[str, Any]) -> Dict[str, Any]:
@@ -94,62 +220,65 @@ def handle_run(payload: Dict[str, Any]) -> Dict[str, Any]:
     il_m1_target, _ = _parse_latest(il_m1_latest, 6)
     il_m2_target, _ = _parse_latest(il_m2_latest, 6)
 
-    # Parse history blobs
-    mm_hist = _parse_hist_blob(payload.get("HIST_MM_BLOB", ""), is_bonus=True)
-    pb_hist = _parse_hist_blob(payload.get("HIST_PB_BLOB", ""), is_bonus=True)
-    il_jp_hist = _parse_hist_blob(payload.get("HIST_IL_JP_BLOB", ""), is_bonus=False)
-    il_m1_hist = _parse_hist_blob(payload.get("HIST_IL_M1_BLOB", ""), is_bonus=False)
-    il_m2_hist = _parse_hist_blob(payload.get("HIST_IL_M2_BLOB", ""), is_bonus=False)
+    # Parse history blobs (capped first: they key the parse cache)
+    mm_hist = _parse_hist_blob_cached(_cap_blob(payload.get("HIST_MM_BLOB")), True)
+    pb_hist = _parse_hist_blob_cached(_cap_blob(payload.get("HIST_PB_BLOB")), True)
+    # IL: JP/M1/M2 history is only ever used mixed together, so parse it as one blob;
+    # each part is capped on its own so a long JP paste can't crowd out M1/M2
+    il_blob = "\n".join(filter(None, (_cap_blob(payload.get("HIST_IL_JP_BLOB")),
+                                      _cap_blob(payload.get("HIST_IL_M1_BLOB")),
+                                      _cap_blob(payload.get("HIST_IL_M2_BLOB")))))
+    il_hist = _parse_hist_blob_cached(il_blob, False)
 
-    random.seed()  # new batch every click
+    # new batch every click; a private instance keeps concurrent requests
+    # from reseeding each other's shared module-level generator
+    rng = random.Random()
 
     # Build 50-row batches
     SIZE = 50
-    batch_mm = _sample_from_hist(mm_hist, k=5, size=SIZE)
-    batch_pb = _sample_from_hist(pb_hist, k=5, size=SIZE)
+    batch_mm = _sample_from_hist(mm_hist, k=5, size=SIZE, rng=rng)
+    batch_pb = _sample_from_hist(pb_hist, k=5, size=SIZE, rng=rng)
     # IL: mix JP/M1/M2 history together for a richer pool
-    batch_il = _sample_from_hist(il_jp_hist + il_m1_hist + il_m2_hist, k=6, size=SIZE)
+    batch_il = _sample_from_hist(il_hist, k=6, size=SIZE, rng=rng)
 
     # Score MM/PB (with bonus) vs their LATEST_*
     def score_with_bonus(batch: List[List[int]], target: List[int], tb: int | None):
-        rows = {"3":[], "4":[], "5":[], "3+B":[], "4+B":[], "5+B":[]}
-        counts = {k:0 for k in rows}
-        exact_rows = []
+        # row indices bucketed by hit count; dicts are built once at the end
+        by_hit: List[List[int]] = [[] for _ in range(len(target) + 1)]
+        tmask = _target_mask(target)
         for i, r in enumerate(batch, start=1):
-            m, hasb = _score_plus_bonus(r, None, target, tb)
-            if m == 5: exact_rows.append(i)
-            if m in (3,4,5):
-                rows[str(m)].append(i); counts[str(m)] += 1
-                if hasb and m in (3,4,5):
-                    rows[f"{m}+B"].append(i); counts[f"{m}+B"] += 1
-        return {"counts": counts, "rows": rows, "exact_rows": exact_rows}
+            by_hit[(_mask(r) & tmask).bit_count()].append(i)
+        rows = {key: by_hit[m] for m, (key, _) in _MM_PB_KEYS.items()}
+        # generated rows carry no bonus, so no row can hit a +B tier
+        rows.update({bkey: [] for _, bkey in _MM_PB_KEYS.values()})
+        counts = {k: len(v) for k, v in rows.items()}
+        return {"counts": counts, "rows": rows, "exact_rows": list(by_hit[5])}
 
     hits_mm = score_with_bonus(batch_mm, mm_target, mm_tb)
     hits_pb = score_with_bonus(batch_pb, pb_target, pb_tb)
 
-    # Score IL (no bonus)
-    def score_il(batch: List[List[int]], target: List[int]):
-        rows = {"3":[], "4":[], "5":[], "6":[]}
-        counts = {k:0 for k in rows}
+    # Score IL (no bonus) vs JP/M1/M2 in one pass: each row's bitmask is
+    # built once and tested against all three target masks
+    def score_il(batch: List[List[int]], targets: Sequence[List[int]]):
+        tmasks = [_target_mask(t) for t in targets]
+        by_hit: List[List[List[int]]] = [[[] for _ in range(len(t) + 1)] for t in targets]
         for i, r in enumerate(batch, start=1):
-            m = _score_lotto(r, target)
-            if m in (3,4,5,6):
-                rows[str(m)].append(i)
-                counts[str(m)] += 1
-        return {"counts": counts, "rows": rows}
+            rm = _mask(r)
+            for buckets, tmask in zip(by_hit, tmasks):
+                buckets[(rm & tmask).bit_count()].append(i)
+        out = []
+        for buckets in by_hit:
+            rows = {key: buckets[m] for m, key in _IL_KEYS.items()}
+            counts = {k: len(v) for k, v in rows.items()}
+            out.append({"counts": counts, "rows": rows})
+        return out
 
-    hits_il_jp = score_il(batch_il, il_jp_target)
-    hits_il_m1 = score_il(batch_il, il_m1_target)
-    hits_il_m2 = score_il(batch_il, il_m2_target)
+    hits_il_jp, hits_il_m1, hits_il_m2 = score_il(batch_il, (il_jp_target, il_m1_target, il_m2_target))
 
     # pretty strings for UI
-    def fmt_row(nums: List[int], bonus: int | None = None) -> str:
-        mains = "-".join(f"{n:02d}" for n in nums)
-        return f"{mains}" if bonus is None else f"{mains}  {bonus:02d}"
-
-    batch_mm_str = [fmt_row(r, None) for r in batch_mm]
-    batch_pb_str = [fmt_row(r, None) for r in batch_pb]
-    batch_il_str = [fmt_row(r, None) for r in batch_il]
+    batch_mm_str = [_fmt_row(r) for r in batch_mm]
+    batch_pb_str = [_fmt_row(r) for r in batch_pb]
+    batch_il_str = [_fmt_row(r) for r in batch_il]
 
     result = {
         "ok": True,
@@ -167,13 +296,22 @@ def handle_run(payload: Dict[str, Any]) -> Dict[str, Any]:
     }
 
     # save to /tmp
-    ts = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    path = f"/tmp/lotto_1_{ts}.json"
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(result, f, ensure_ascii=False, indent=2)
+    # ms + pid + per-process sequence: runs in the same second (or from another
+    # gunicorn worker) no longer overwrite each other, and names still sort by time
+    now = datetime.now()
+    name = (f"lotto_1_{now:%Y-%m-%d_%H-%M-%S}_{now.microsecond // 1000:03d}"
+            f"_{os.getpid()}_{next(_SAVE_SEQ):06d}.json")
+    path = os.path.join(_SAVE_DIR, name)
+    # serialize once on the request thread; the disk write happens off it, so
+    # saved_path names where the file is going - a failed write is only logged
+    _WRITER.submit(_write_bytes, path, _json_dumps_bytes(result)).add_done_callback(_report_write_error)
     result["saved_path"] = path
     return result
 
 def recent_files() -> list[str]:
-    import glob
-    return sorted(glob.glob("/tmp/lotto_1_*.json"))[-20:]
+    # one scandir pass; DirEntry names need no per-file stat or fnmatch
+    with os.scandir(_SAVE_DIR) as it:
+        names = [e.name for e in it if e.name.startswith("lotto_1_") and e.name.endswith(".json")]
+    # names embed a sortable timestamp: keep the newest 20 with a bounded heap,
+    # returned oldest-first as before
+    return [os.path.join(_SAVE_DIR, n) for n in sorted(heapq.nlargest(20, names))]
@@ -1,16 +1,40 @@
 from __future__ import annotations
 
+import bisect
 import csv
 import io
 import json
 import os
+import threading
 from datetime import datetime
+from functools import lru_cache
 from typing import Dict, Any, List, Tuple, Optional
 
+from lottery_core import fmt_nums
+
 STORE_PATH = "/tmp/lotto_store.json"
 _DB: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+_DB_SIG: Optional[Tuple[int, int, int]] = None  # (ino, mtime_ns, size) of the file _DB was read from
+# derived results keyed by query args; cleared whenever _DB changes
+_HIST_CACHE: Dict[Tuple[str, str, str, int], List[str]] = {}
+_HIST_CACHE_MAX = 256
+# (game, tier) -> (rows newest first, their formatted history lines, negated date
+# ordinals ascending for bisect); built lazily, cleared with _HIST_CACHE
+_ORDER: Dict[Tuple[str, str], Tuple[List[Dict[str, Any]], List[str], List[int]]] = {}
+_KEYS: Optional[List[Tuple[str, str, str]]] = None  # sorted list_keys() result
+# gunicorn runs several threads per worker: a cache fill records _GEN before it
+# reads _DB and is dropped if _invalidate() ran meanwhile, so a value computed
+# from the old store can't outlive the change. _LOCK makes check+store atomic.
+_LOCK = threading.Lock()
+_GEN = 0
+# held by import_csv from _load() through _save(), so two imports can't both copy
+# the same _DB and have the later save drop the other's rows
+_WRITE_LOCK = threading.Lock()
 
 # ---------- dates ----------
+# the store holds a small set of distinct dates that get parsed over and over
+# (every sort key, every lookup), so both conversions are memoized
+@lru_cache(maxsize=8192)
 def _norm_date(s: str) -> str:
     s = (s or "").strip()
     fmts = [
@@ -26,9 +50,40 @@ def _norm_date(s: str) -> str:
             last = e
     raise ValueError(f"Unrecognized date: {s!r} ({last})")
 
+@lru_cache(maxsize=8192)
+def _parse_date(s: str) -> datetime:
+    """Parse a normalized MM/DD/YYYY store date."""
+    return datetime.strptime(s, "%m/%d/%Y")
+
+def _date_ord(s: str) -> int:
+    """MM/DD/YYYY -> YYYYMMDD as an int: sorts chronologically, no strptime."""
+    return int(s[6:] + s[:2] + s[3:5])
+
+def _file_sig() -> Optional[Tuple[int, int, int]]:
+    # _save() replaces the file, so every save gets a new inode even when mtime
+    # and size match the old one
+    try:
+        st = os.stat(STORE_PATH)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def _invalidate():
+    global _KEYS, _GEN
+    with _LOCK:
+        _GEN += 1
+        _HIST_CACHE.clear()
+        _ORDER.clear()
+        _KEYS = None
+
 def _load():
-    global _DB
-    if os.path.exists(STORE_PATH):
+    # keep the parsed store in memory and only re-read it when the file changed
+    # (another gunicorn worker may have imported since we last looked)
+    global _DB, _DB_SIG
+    sig = _file_sig()
+    if sig is not None and sig == _DB_SIG:
+        return
+    if sig is not None:
         try:
             with open(STORE_PATH, "r", encoding="utf-8") as f:
                 raw = json.load(f)
@@ -37,59 +92,121 @@ def _load():
             _DB = {}
     else:
         _DB = {}
+    _DB_SIG = sig
+    _invalidate()
 
-def _save():
-    data = {",".join(k): v for k, v in _DB.items()}
-    with open(STORE_PATH, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False)
+def _save(db: Dict[Tuple[str, str, str], Dict[str, Any]]):
+    # write db, then publish it as _DB; a failed write leaves _DB untouched
+    global _DB, _DB_SIG
+    data = {",".join(k): v for k, v in db.items()}
+    # serialize up front, then one write instead of json.dump's chunked stream;
+    # written beside the store and renamed over it, so readers (here or in another
+    # worker) never see a half-written file
+    body = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    tmp = f"{STORE_PATH}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(body)
+    os.replace(tmp, STORE_PATH)
+    _DB = db
+    _DB_SIG = _file_sig()
+    _invalidate()
 
 # ---------- CSV import ----------
+_NULLS = frozenset(("", "null"))  # cell values that mean "no number"
+
 def import_csv(text: str, overwrite: bool = False) -> Dict[str, int]:
-    _load()
-    buf = io.StringIO(text)
-    reader = csv.DictReader(buf)
-    added = updated = 0
+    reader = csv.reader(io.StringIO(text))
+    header = next(reader, [])
+    # resolve column positions once; a missing column maps to the padding slot
+    # at index `width`, which always reads as None (same as DictReader's .get)
+    width = len(header)
+    pos = {name: i for i, name in enumerate(header)}
+    i_game, i_date, i_tier, i_bonus = (pos.get(k, width) for k in ("game", "draw_date", "tier", "bonus"))
+    i_nums = tuple(pos.get(k, width) for k in ("n1","n2","n3","n4","n5","n6"))
+    parsed = []
     for row in reader:
-        game = (row.get("game") or "").strip()      # "MM","PB","IL"
-        draw_date = _norm_date(row.get("draw_date") or "")
-        tier = (row.get("tier") or "").strip()      # "", "JP","M1","M2"
+        if not row:
+            continue
+        n = len(row)
+        if n != width:
+            row = row[:width] if n > width else row + [None] * (width - n)
+        row.append(None)
+        game = (row[i_game] or "").strip()      # "MM","PB","IL"
+        draw_date = _norm_date(row[i_date] or "")
+        tier = (row[i_tier] or "").strip()      # "", "JP","M1","M2"
         mains = []
-        for k in ("n1","n2","n3","n4","n5","n6"):
-            v = row.get(k)
-            if v is None or v == "" or v == "null":
+        for i in i_nums:
+            v = row[i]
+            if v is None or v in _NULLS:
                 continue
             mains.append(int(v))
-        braw = row.get("bonus")
-        bonus = None if (braw is None or braw == "" or braw == "null") else int(braw)
-
-        key = (game, draw_date, tier)
-        payload = {"game": game, "date": draw_date, "tier": tier, "mains": mains, "bonus": bonus}
-        if key in _DB:
-            if overwrite:
-                _DB[key] = payload
-                updated += 1
-        else:
-            _DB[key] = payload
-            added += 1
-    _save()
+        braw = row[i_bonus]
+        bonus = None if (braw is None or braw in _NULLS) else int(braw)
+
+        parsed.append(((game, draw_date, tier),
+                       {"game": game, "date": draw_date, "tier": tier, "mains": mains, "bonus": bonus}))
+
+    added = updated = 0
+    with _WRITE_LOCK:
+        _load()
+        # merge into a copy: other threads may be reading _DB, and a failed save
+        # must not leave the rows behind
+        db = dict(_DB)
+        for key, payload in parsed:
+            if key in db:
+                if overwrite:
+                    db[key] = payload
+                    updated += 1
+            else:
+                db[key] = payload
+                added += 1
+        _save(db)
     return {"added": added, "updated": updated, "total": added + updated}
 
 # ---------- lookups ----------
+def _fmt_line(game: str, rec: Dict[str, Any]) -> str:
+    d = rec["date"]
+    parts = [f"{d[6:]}-{d[:2]}-{d[3:5]}", fmt_nums(rec["mains"])]
+    if game in ("MM","PB"):
+        parts.append(f"{(rec['bonus'] or 0):02d}")
+    return "  ".join(parts)
+
+def _index(game: str, tier: str) -> Tuple[List[Dict[str, Any]], List[str], List[int]]:
+    """Rows for (game, tier) newest first, their history lines and sort keys. Built once per store version."""
+    k = (game, tier or "")
+    idx = _ORDER.get(k)
+    if idx is None:
+        gen = _GEN
+        rows = [r for (g, _, t), r in _DB.items() if g == game and (t or "") == k[1]]
+        rows.sort(key=lambda r: _date_ord(r["date"]), reverse=True)
+        idx = (rows, [_fmt_line(game, r) for r in rows], [-_date_ord(r["date"]) for r in rows])
+        with _LOCK:
+            if gen == _GEN:
+                _ORDER[k] = idx
+    return idx
+
 def list_keys() -> List[Tuple[str, str, str]]:
+    global _KEYS
     _load()
-    return sorted(_DB.keys(), key=lambda k: (k[0], k[2], datetime.strptime(k[1], "%m/%d/%Y")), reverse=True)
+    keys = _KEYS
+    if keys is None:
+        gen = _GEN
+        keys = sorted(_DB.keys(), key=lambda k: (k[0], k[2], _date_ord(k[1])), reverse=True)
+        with _LOCK:
+            if gen == _GEN:
+                _KEYS = keys
+    return list(keys)
 
 def dates_for(game: str, tier: str = "") -> List[str]:
     _load()
-    ds = {dd for (g, dd, t) in _DB.keys() if g == game and (t or "") == (tier or "")}
-    return sorted(ds, key=lambda s: datetime.strptime(s, "%m/%d/%Y"), reverse=True)
+    return [r["date"] for r in _index(game, tier)[0]]
 
 def nearest_dates(game: str, target: str, tier: str = "", n: int = 3) -> List[str]:
     ds = dates_for(game, tier)
     if not ds:
         return []
-    target_dt = datetime.strptime(target, "%m/%d/%Y")
-    return sorted(ds, key=lambda s: abs((datetime.strptime(s, "%m/%d/%Y") - target_dt).days))[:n]
+    target_dt = _parse_date(target)
+    return sorted(ds, key=lambda s: abs((_parse_date(s) - target_dt).days))[:n]
 
 def get_by_date(game: str, date: str, tier: str = "") -> Optional[List[Any]]:
     _load()
@@ -97,26 +214,27 @@ def get_by_date(game: str, date: str, tier: str = "") -> Optional[List[Any]]:
     rec = _DB.get(key)
     if not rec:
         return None
-    return [rec["mains"], rec["bonus"]]
+    return [list(rec["mains"]), rec["bonus"]]  # copy: rec is the live store row
 
 def get_history(game: str, since_date: str, tier: str = "", limit: int = 20) -> List[str]:
     _load()
     g, t = game.strip(), tier.strip()
     since = _norm_date(since_date)
-    rows = [r for (gg, dd, tt), r in _DB.items() if gg == g and (tt or "") == (t or "")]
-    rows.sort(key=lambda r: datetime.strptime(r["date"], "%m/%d/%Y"), reverse=True)
-    # start at matching since
-    start = 0
-    for i, r in enumerate(rows):
-        if r["date"] == since:
-            start = i
-            break
-    rows = rows[start:start+int(limit)]
-    out = []
-    for rec in rows:
-        mains = "-".join(f"{n:02d}" for n in rec["mains"])
-        if g in ("MM","PB"):
-            out.append(f"{rec['date'][6:]}-{rec['date'][:2]}-{rec['date'][3:5]}  {mains}  {(rec['bonus'] or 0):02d}")
-        else:
-            out.append(f"{rec['date'][6:]}-{rec['date'][:2]}-{rec['date'][3:5]}  {mains}")
-    return out
+    key = (g, t, since, int(limit))
+    cached = _HIST_CACHE.get(key)
+    if cached is not None:
+        return list(cached)
+    gen = _GEN
+    _, lines, negs = _index(g, t)
+    # start at matching since (binary search; no exact match starts at the newest)
+    o = -_date_ord(since)
+    start = bisect.bisect_left(negs, o)
+    if start == len(negs) or negs[start] != o:
+        start = 0
+    out = lines[start:start+int(limit)]
+    with _LOCK:
+        if gen == _GEN:
+            if len(_HIST_CACHE) >= _HIST_CACHE_MAX:
+                _HIST_CACHE.clear()
+            _HIST_CACHE[key] = out
+    return list(out)